@@ -1,11 +1,17 @@
 # Requirements:
-# pip install streamlit geopandas pandas streamlit-folium folium shapely
+# pip install streamlit geopandas pandas pyarrow streamlit-folium folium shapely
 
 import streamlit as st
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import shapely
 import folium
 from streamlit_folium import st_folium
+import io
+import html
+import os
+import hashlib
 import zipfile
 import tempfile
 
@@ -17,32 +23,107 @@ st.sidebar.header("Upload Data")
 csv_file = st.sidebar.file_uploader("Upload clinic CSV", type=["csv"])
 shp_zip = st.sidebar.file_uploader("Upload catchment shapefile ZIP", type=["zip"])
 
-def load_shapefile(zip_file):
-    """Extract and load a shapefile from a ZIP archive."""
+@st.cache_data(show_spinner=False)
+def load_clinics(csv_bytes):
+    """Load the clinic CSV into a GeoDataFrame, cached on the upload's bytes."""
+    clinics_df = pd.read_csv(io.BytesIO(csv_bytes))
+    return gpd.GeoDataFrame(
+        clinics_df,
+        geometry=shapely.points(clinics_df['long'].to_numpy(), clinics_df['lat'].to_numpy()),
+        crs="EPSG:4326"
+    )
+
+PARQUET_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ovum_shapefile_cache")
+# Most recently used Parquet files kept on disk; older ones are evicted
+PARQUET_CACHE_MAX_FILES = 20
+# Uploads whose layers are kept in process memory across all sessions
+SHAPEFILE_CACHE_ENTRIES = 8
+
+def prune_parquet_cache():
+    """Delete the least recently used files beyond PARQUET_CACHE_MAX_FILES."""
+    try:
+        paths = [os.path.join(PARQUET_CACHE_DIR, f) for f in os.listdir(PARQUET_CACHE_DIR)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+    except OSError:
+        return
+    for path in paths[PARQUET_CACHE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def write_parquet_cache(gdf, cache_path):
+    """Best-effort write of gdf to cache_path; a failure only skips the cache."""
+    tmp_path = None
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PARQUET_CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        gdf.to_parquet(tmp_path)
+        # Atomic rename so readers never see a half-written file
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+    except Exception:
+        # Unwritable dir, missing pyarrow or a column Arrow can't store
+        pass
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    prune_parquet_cache()
+
+@st.cache_resource(show_spinner=False, max_entries=SHAPEFILE_CACHE_ENTRIES)
+def load_shapefile(zip_bytes):
+    """Load a zipped shapefile reprojected to WGS84.
+
+    The first load converts the layer to Parquet on disk; later loads of the
+    same ZIP read the Parquet file instead of going through the SHP driver.
+    An unreadable cache file is discarded and the layer is rebuilt from the SHP.
+    """
+    digest = hashlib.sha256(zip_bytes).hexdigest()
+    cache_path = os.path.join(PARQUET_CACHE_DIR, f"{digest}.parquet")
+    if os.path.exists(cache_path):
+        try:
+            gdf = gpd.read_parquet(cache_path)
+        except Exception:
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+        else:
+            try:
+                # Mark as recently used so eviction keeps it
+                os.utime(cache_path)
+            except OSError:
+                pass
+            return gdf
+
     with tempfile.TemporaryDirectory() as tmpdir:
-        z = zipfile.ZipFile(zip_file)
+        z = zipfile.ZipFile(io.BytesIO(zip_bytes))
         z.extractall(tmpdir)
         for fname in z.namelist():
             if fname.endswith('.shp'):
-                return gpd.read_file(f"{tmpdir}/{fname}")
+                gdf = gpd.read_file(f"{tmpdir}/{fname}").to_crs(epsg=4326)
+                write_parquet_cache(gdf, cache_path)
+                return gdf
     return None
 
+@st.cache_resource(show_spinner=False, max_entries=SHAPEFILE_CACHE_ENTRIES)
+def catchments_geojson(zip_bytes):
+    """Serialize the catchment layer to a GeoJSON string once per upload."""
+    return load_shapefile(zip_bytes).to_json()
+
 if csv_file and shp_zip:
-    # Load clinics CSV into GeoDataFrame
-    clinics_df = pd.read_csv(csv_file)
-    clinics_gdf = gpd.GeoDataFrame(
-        clinics_df,
-        geometry=gpd.points_from_xy(clinics_df['long'], clinics_df['lat']),
-        crs="EPSG:4326"
-    )
-    # Load catchment shapefile
-    catchments_gdf = load_shapefile(shp_zip)
-    if catchments_gdf is not None:
-        catchments_gdf = catchments_gdf.to_crs(epsg=4326)
+    # Load clinics CSV into GeoDataFrame (cached across reruns)
+    clinics_gdf = load_clinics(csv_file.getvalue())
+    # Load catchment shapefile (cached across reruns)
+    catchments_gdf = load_shapefile(shp_zip.getvalue())
 
-    # Compute map center as average of clinic coordinates
-    center_lat = clinics_gdf.geometry.y.mean()
-    center_lon = clinics_gdf.geometry.x.mean()
+    # Compute map center from the CSV's WGS84 columns; no geometry access needed
+    center_lat = clinics_gdf['lat'].mean()
+    center_lon = clinics_gdf['long'].mean()
     center = [center_lat, center_lon]
 
     # Create a full-width Folium map with a clean basemap
@@ -74,25 +155,39 @@ if csv_file and shp_zip:
             }
 
         folium.GeoJson(
-            catchments_gdf,
+            catchments_geojson(shp_zip.getvalue()),
             name="Catchments",
             style_function=style_function,
             tooltip=folium.GeoJsonTooltip(fields=['radius_km'], aliases=['Radius (km):'])
         ).add_to(m)
 
-    # Add clinic markers with circle markers and labels
+    # Add clinic markers as a single GeoJSON layer of circle markers
     colors = ['#FF3333', '#33FF57', '#FF33F6', '#33FFF2']
-    for idx, row in clinics_gdf.iterrows():
-        folium.CircleMarker(
-            location=[row.geometry.y, row.geometry.x],
-            radius=7,
-            color=colors[idx % len(colors)],
-            fill=True,
-            fill_color=colors[idx % len(colors)],
-            fill_opacity=0.8,
-            popup=folium.Popup(str(row.get('name', 'Clinic')), parse_html=True),
-            tooltip=str(row.get('name', 'Clinic'))
-        ).add_to(m)
+    # GeoJsonPopup/GeoJsonTooltip insert values as raw innerHTML, so escape names
+    if 'name' in clinics_gdf.columns:
+        names = [html.escape(name) for name in clinics_gdf['name'].astype(str)]
+    else:
+        names = ['Clinic'] * len(clinics_gdf)
+    clinic_points = gpd.GeoDataFrame(
+        {
+            'name': names,
+            'color': np.take(colors, np.arange(len(clinics_gdf)), mode='wrap'),
+        },
+        geometry=clinics_gdf.geometry.values,
+        crs="EPSG:4326"
+    )
+    folium.GeoJson(
+        clinic_points.to_json(),
+        name="Clinics",
+        marker=folium.CircleMarker(radius=7, fill=True, fill_opacity=0.8),
+        style_function=lambda feature: {
+            'color': feature['properties']['color'],
+            'fillColor': feature['properties']['color'],
+            'fillOpacity': 0.8,
+        },
+        popup=folium.GeoJsonPopup(fields=['name'], labels=False),
+        tooltip=folium.GeoJsonTooltip(fields=['name'], labels=False)
+    ).add_to(m)
 
     # Display the map full-width
     st.subheader("Clinic Locations & Catchment Boundaries")